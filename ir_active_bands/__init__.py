@@ -1,4 +1,5 @@
 from ir_active_bands.ir_active_bands import wvl2wvn
 from ir_active_bands.ir_active_bands import wvn2wvl
 from ir_active_bands.ir_active_bands import combine
-from ir_active_bands.ir_active_bands import IRActiveBands
\ No newline at end of file
+from ir_active_bands.ir_active_bands import IRActiveBands
+from ir_active_bands.ir_active_bands import get_ir_active_bands
\ No newline at end of file
@@ -8,15 +8,24 @@ Date: 02-09-2022
 from typing import Union
 from typing import Dict
 from typing import List
-import itertools
+from functools import lru_cache
+import hashlib
+from math import comb
 from pathlib import Path
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 from matplotlib.colors import Normalize
+try:
+    from numba import njit
+    from numba import prange
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
 
 UNITS = 'microns'
+# microns-to-wavenumber conversion factor, 1E6 * 1E-2 folded at import
+_WV_CONST = 1E4
 LEVELS = {
     'fundamental': 1.0,
     'overtone': 0.9,
@@ -28,6 +37,21 @@ LEVELS = {
     'fundamental+overtone+overtone': 0.3,
     'overtone+overtone+overtone': 0.2
 }
+# the LEVELS values as an array, so the level of any absorption can be
+# gathered from its integer type code (the position of the type in LEVELS)
+LEVEL_VALUES = np.array(list(LEVELS.values()), dtype=np.float32)
+TYPE_CODES = {name: code for code, name in enumerate(LEVELS)}
+# lookup table of combination type codes, indexed by the size of the
+# combination and the number of overtones it contains; since fundamentals
+# precede overtones in the absorptions table, the combination type is fully
+# determined by these two counts, so the hot path can use integer indexing
+# instead of string joins and dict hashes
+CODE_TABLE = np.full((3, 4), -1, dtype=np.int8)
+for _k in range(1, 4):
+    for _n_over in range(_k + 1):
+        _type = '+'.join(['fundamental'] * (_k - _n_over) + ['overtone'] * _n_over)
+        CODE_TABLE[_k - 1, _n_over] = TYPE_CODES[_type]
+del _k, _n_over, _type
 LEVELS_SHRT = {
     'fundamental': 1.0,
     'overtone': 0.9,
@@ -48,6 +72,13 @@ FUNDAMENTALS = {
     'OH': {'v1': 2.75},
     'CO3': {'v1': 9.23, 'v2': 11.36, 'v3': 7.0, 'v4': 14.0}
 }
+# directory for the on-disk cache of computed absorption tables
+CACHE_DIR = Path.home() / '.cache' / 'ir_active_bands'
+# colormap and level normalisation for visualise_absorptions, resolved once at
+# import rather than on every call
+_TAB_CM = plt.get_cmap('tab10_r')
+_NORM = Normalize(vmin=0.1, vmax=1.0)
+_BAR_WIDTH_SCALE = 1 / 150
 
 class IRActiveBands:
     """A class for computing Infrared Active Band overtones and combinations from the fundamental
@@ -75,11 +106,53 @@ class IRActiveBands:
             data=fundamentals_dict.values(),
             index=fundamentals_dict.keys(),
             columns=['band-centre'])
-        self.fundamentals['type'] = 'fundamental'
-        self.fundamentals['level'] = LEVELS['fundamental']
-        self.absorptions = self.fundamentals
+        self.fundamentals['type'] = pd.Categorical(
+            ['fundamental'] * len(fundamentals_dict), categories=list(LEVELS.keys()))
+        self.fundamentals['level'] = np.float32(LEVELS['fundamental'])
+        # the absorptions are held internally as parallel arrays; the DataFrame
+        # exposed by the absorptions property is materialized lazily from these
+        self._labels = list(fundamentals_dict.keys())
+        # band-centres are stored in wavenumber, where the combination and
+        # overtone arithmetic is purely additive; conversion to wavelength
+        # happens once, when the DataFrame is materialized
+        self._wvn = wvl2wvn(np.array(list(fundamentals_dict.values()), dtype=np.float64))
+        self._type_code = np.full(len(self._wvn), TYPE_CODES['fundamental'], dtype=np.int8)
+        self._lvl = np.full(len(self._wvn), LEVELS['fundamental'], dtype=np.float32)
+        self._absorptions_df = None
         self.overtones = None # populated in the compute_overtones() method
 
+    @property
+    def absorptions(self) -> pd.DataFrame:
+        """The absorption features as a DataFrame, built on demand from the
+        internal arrays and cached until they next change.
+
+        :return: table of absorption features
+        :rtype: pd.DataFrame
+        """
+        if self._absorptions_df is None:
+            self._absorptions_df = pd.DataFrame(data={
+                    'band-centre': wvn2wvl(self._wvn),
+                    'type': pd.Categorical.from_codes(
+                        self._type_code, categories=list(LEVELS.keys())),
+                    'level': self._lvl},
+                    index=self._labels)
+        return self._absorptions_df
+
+    @absorptions.setter
+    def absorptions(self, table: pd.DataFrame) -> None:
+        """Replace the absorption features with those of the given DataFrame,
+        decoding it into the internal arrays.
+
+        :param table: table of absorption features
+        :type table: pd.DataFrame
+        """
+        self._labels = list(table.index)
+        self._wvn = wvl2wvn(table['band-centre'].to_numpy(dtype=np.float64))
+        self._type_code = np.fromiter(
+            (TYPE_CODES[t] for t in table['type']), dtype=np.int8, count=len(table))
+        self._lvl = table['level'].to_numpy(dtype=np.float32)
+        self._absorptions_df = None
+
     def compute_combinations_and_show(self, range: List = None) -> pd.DataFrame:
         """Top level function for comuting the overtones and combinations, collecting these,
         and displaying the complete set of absorptions within the given range.
@@ -109,19 +182,24 @@ class IRActiveBands:
         :return: overtones in wavelength
         :rtype: np.array
         """
-        fundamentals_dict = self.fundamentals['band-centre'].to_dict()
-        overtones_dict = {}
-        for identifier, wavelength in fundamentals_dict.items():
-            for k in [2,3]:
-                overtone_key = str(k) + identifier
-                overtones_dict[overtone_key] = wavelength / k # divide by factor
-        self.overtones = pd.DataFrame(
-            data=overtones_dict.values(),
-            index=overtones_dict.keys(),
-            columns=['band-centre'])
-        self.overtones['type'] = 'overtone'
-        self.overtones['level'] = LEVELS['overtone']
-        self.absorptions = pd.concat([self.absorptions, self.overtones])
+        identifiers = self.fundamentals.index.to_numpy().astype(str)
+        n_fund = len(identifiers)
+        ks = np.array([2, 3])
+        # each overtone wavenumber is an integer multiple of its fundamental;
+        # broadcasting with the fundamentals on the leading axis keeps the
+        # id-major ordering (2v1, 3v1, 2v2, ...) of the returned dictionary
+        overtone_wvn = (self._wvn[:n_fund, None] * ks[None, :]).ravel()
+        overtone_keys = np.char.add(ks.astype(str)[None, :], identifiers[:, None]).ravel()
+        n_over = len(overtone_keys)
+        self._labels += list(overtone_keys)
+        self._wvn = np.concatenate([self._wvn, overtone_wvn])
+        self._type_code = np.concatenate([
+            self._type_code, np.full(n_over, TYPE_CODES['overtone'], dtype=np.int8)])
+        self._lvl = np.concatenate([
+            self._lvl, np.full(n_over, LEVELS['overtone'], dtype=np.float32)])
+        self._absorptions_df = None
+        self.overtones = self.absorptions.iloc[n_fund:]
+        overtones_dict = dict(zip(overtone_keys, wvn2wvl(overtone_wvn)))
         return overtones_dict
 
     def compute_combinations(self) -> Dict:
@@ -134,46 +212,40 @@ class IRActiveBands:
         :return: combinations absorption features
         :rtype: Dict
         """
-        combinations = {}
         # check that the combinations haven't already been computed by checking that the only
         # 'types' are fundamentals and overtones:
-        if not np.array_equal(['fundamental', 'overtone'], self.absorptions.type.unique()):
+        if not np.array_equal(
+                np.unique(self._type_code),
+                [TYPE_CODES['fundamental'], TYPE_CODES['overtone']]):
             raise ValueError('Band combinations have likely already been computed, \
                             as types other than "fundamental" and "overtone" are present.')
-        # make combination list
-        pairs = [[a,b] for a,b in itertools.combinations(self.absorptions.index, 2)]
-        triplets = [[a,b,c] for a,b,c in itertools.combinations(self.absorptions.index, 3)]
-        # iterate over combinations, and compute
-        for pair in pairs:
-            # get the absorptions given by the keys
-            features = self.absorptions.loc[pair]
-            band_centre = combine(features)
-            label = '+'.join(pair)
-            combination_type = '+'.join(features['type'])
-            level = LEVELS[combination_type]
-            combinations[id] = band_centre
-            absorption = pd.DataFrame(data={
-                    'band-centre': band_centre,
-                    'type': combination_type,
-                    'level': level},
-                    index=[label])
-            self.absorptions = pd.concat([self.absorptions, absorption])
-
-        for triplet in triplets:
-            # get the absorptions given by the keys
-            features = self.absorptions.loc[triplet]
-            band_centre = combine(features)
-            label = '+'.join(triplet)
-            combination_type = '+'.join(features['type'])
-            level = LEVELS[combination_type]
-            combinations[label] = band_centre
-            absorption = pd.DataFrame(data={
-                    'band-centre': band_centre,
-                    'type': combination_type,
-                    'level': level},
-                    index=[label])
-            self.absorptions = pd.concat([self.absorptions, absorption])
+        # combination is additive in the wavenumber domain, which is exactly
+        # how the band-centres are stored - no reciprocals on the hot path;
+        # the numeric tables come from the cached pure core, so repeated
+        # calls with the same fundamentals are dictionary lookups
+        names = np.asarray(self._labels, dtype=str)
+        is_over = (self._type_code == TYPE_CODES['overtone']).astype(np.int8)
+        wvn_out, code_out, indices = _combination_tables(
+            tuple(self._wvn.tolist()), tuple(is_over.tolist()))
+        # the labels depend on the member names, not just their wavenumbers,
+        # so they are joined here rather than in the cached core
+        labels_out = np.empty(len(wvn_out), dtype=object)
+        start = 0
+        for k, idx in zip([2,3], indices):
+            stop = start + len(idx)
+            labels = names[idx[:,0]]
+            for col in range(1, k):
+                labels = np.char.add(np.char.add(labels, '+'), names[idx[:,col]])
+            labels_out[start:stop] = labels
+            start = stop
+        # append all of the new rows to the internal arrays in one pass
+        self._labels += list(labels_out)
+        self._wvn = np.concatenate([self._wvn, wvn_out])
+        self._type_code = np.concatenate([self._type_code, code_out])
+        self._lvl = np.concatenate([self._lvl, LEVEL_VALUES[code_out]])
+        self._absorptions_df = None
         # return dictionary
+        combinations = dict(zip(labels_out, wvn2wvl(wvn_out)))
         return combinations
 
     def filter_absorptions(self, spectral_range: List) -> List:
@@ -186,13 +258,17 @@ class IRActiveBands:
         :return: absorption features that have been removed
         :rtype: List
         """
-        dropped_features = self.absorptions[
-            (self.absorptions['band-centre'] < spectral_range[0]) &
-                    (self.absorptions['band-centre'] > spectral_range[1])
-            ].index
-        self.absorptions = self.absorptions[
-            (self.absorptions['band-centre'] >= spectral_range[0]) &
-                    (self.absorptions['band-centre'] <= spectral_range[1])]
+        # build the in-range mask once on the internal band-centre array; the
+        # dropped features are simply its complement
+        band_centres = wvn2wvl(self._wvn)
+        keep = (band_centres >= spectral_range[0]) & (band_centres <= spectral_range[1])
+        labels = np.asarray(self._labels, dtype=object)
+        dropped_features = pd.Index(labels[~keep])
+        self._labels = list(labels[keep])
+        self._wvn = self._wvn[keep]
+        self._type_code = self._type_code[keep]
+        self._lvl = self._lvl[keep]
+        self._absorptions_df = None
         return dropped_features
 
     def export_absorptions(self, path: str) -> None:
@@ -210,18 +286,18 @@ class IRActiveBands:
     def visualise_absorptions(self, **path: str) -> None:
         """Visualise the absorption features in a figure
         """
-        band_centres = self.absorptions['band-centre']
-        levels = self.absorptions['level']
+        # pull both columns out as numpy arrays so matplotlib ingests plain
+        # C arrays with no Series wrapping
+        band_centres = self.absorptions['band-centre'].to_numpy()
+        levels = self.absorptions['level'].to_numpy()
 
-        # converting levels to colours
-        tab_cm = cm.get_cmap('tab10_r')
-        norm = Normalize(vmin=0.1, vmax=1.0)
-        colors = tab_cm(norm(levels))
+        # converting levels to colours with the cached colormap
+        colors = _TAB_CM(_NORM(levels))
 
         # make plot
         CM = 1/2.54
         fig, ax = plt.subplots(figsize=[15*CM, 10*CM])
-        ax.bar(band_centres, height = levels, width = band_centres/150, color = colors)
+        ax.bar(band_centres, height = levels, width = band_centres*_BAR_WIDTH_SCALE, color = colors)
 
         # add grid
         ax.grid(which='major', axis='y', lw=0.8)
@@ -254,6 +330,48 @@ class IRActiveBands:
         """
         return self.absorptions.to_string()
 
+def _cache_path(molecule: str) -> Path:
+    """Return the on-disk cache location of the absorptions table for the
+    given molecule. The fundamentals are hashed into the filename, so editing
+    a molecule's entry in FUNDAMENTALS invalidates its cached table.
+
+    :param molecule: name of a molecule in the FUNDAMENTALS dictionary
+    :type molecule: str
+    :return: path of the cached absorptions table
+    :rtype: Path
+    """
+    fingerprint = hashlib.md5(
+        repr(sorted(FUNDAMENTALS[molecule].items())).encode()).hexdigest()[:8]
+    return CACHE_DIR / f'{molecule}-{fingerprint}.csv'
+
+@lru_cache(maxsize=None)
+def get_ir_active_bands(molecule: str) -> IRActiveBands:
+    """Return a fully computed IRActiveBands object for the given molecule,
+    cached per molecule name.
+
+    The overtones and combinations are computed on the first call for each
+    molecule and the resulting table is stored under CACHE_DIR, so later
+    processes load it from disk instead of recomputing. Repeated calls in the
+    same process return the same shared object, so callers that need to
+    mutate the result (e.g. with filter_absorptions) should take a
+    copy.deepcopy first.
+
+    :param molecule: name of a molecule in the FUNDAMENTALS dictionary
+    :type molecule: str
+    :return: absorptions object with overtones and combinations computed
+    :rtype: IRActiveBands
+    """
+    bands = IRActiveBands(molecule)
+    cache_file = _cache_path(molecule)
+    if cache_file.exists():
+        bands.absorptions = pd.read_csv(cache_file, index_col=0)
+        return bands
+    bands.compute_overtones()
+    bands.compute_combinations()
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    bands.absorptions.to_csv(cache_file)
+    return bands
+
 def wvl2wvn(wavelength: Union[float, np.array]) -> Union[float, np.array]:
     """Convert from wavelength (microns) to wavenumber (cm^-1)
 
@@ -262,7 +380,7 @@ def wvl2wvn(wavelength: Union[float, np.array]) -> Union[float, np.array]:
     :return: wavenumber in cm^-1
     :rtype: float
     """
-    wavenumber = (1E6 * 1E-2) / wavelength
+    wavenumber = _WV_CONST / wavelength
     return  wavenumber
 
 def wvn2wvl(wavenumber: Union[float, np.array]) -> Union[float, np.array]:
@@ -273,21 +391,147 @@ def wvn2wvl(wavenumber: Union[float, np.array]) -> Union[float, np.array]:
     :return: wavelength in microns
     :rtype: float
     """
-    wavelength = (1E6 * 1E-2) / wavenumber
+    wavelength = _WV_CONST / wavenumber
     return wavelength
 
-def combine(features: pd.DataFrame) -> float:
-    """Combine the given absorptions frequencies
+def combine(band_centres: np.array) -> float:
+    """Combine the given absorption band-centres
 
-    :param absorptions: absorptions in wavelength to combine
-    :type fundamentals: Tuple[]
-    :return: combination frequency in wavelength
+    The wavelength-to-wavenumber conversion constants cancel in the
+    combination arithmetic, so this reduces to a single reciprocal sum.
+
+    :param band_centres: absorption band-centres in wavelength to combine
+    :type band_centres: np.array
+    :return: combination band-centre in wavelength
     :rtype: float
     """
-    absorptions = wvl2wvn(features['band-centre'].to_numpy())
-    combination = np.sum(absorptions)
-    combination = wvn2wvl(combination)
-    return combination
+    return 1.0 / np.reciprocal(band_centres).sum()
+
+def _pair_indices(n: int) -> np.ndarray:
+    """Build the (C(n,2), 2) array of pair member indices, in the same
+    lexicographic order as itertools.combinations, without Python tuples.
+
+    :param n: number of absorptions to combine
+    :type n: int
+    :return: pair member indices
+    :rtype: np.ndarray
+    """
+    i, j = np.triu_indices(n, k=1)
+    return np.stack((i, j), axis=1)
+
+def _triplet_indices(n: int) -> np.ndarray:
+    """Build the (C(n,3), 3) array of triplet member indices, in the same
+    lexicographic order as itertools.combinations, without Python tuples.
+
+    :param n: number of absorptions to combine
+    :type n: int
+    :return: triplet member indices
+    :rtype: np.ndarray
+    """
+    pairs = _pair_indices(n)
+    # each pair (i, j) extends to one triplet per third member k in (j, n)
+    reps = n - 1 - pairs[:, 1]
+    i = np.repeat(pairs[:, 0], reps)
+    j = np.repeat(pairs[:, 1], reps)
+    # the ragged ranges j+1..n-1, concatenated without a Python loop
+    offsets = np.repeat(np.cumsum(reps) - reps, reps)
+    k = np.arange(reps.sum()) - offsets + j + 1
+    return np.stack((i, j, k), axis=1)
+
+if _HAVE_NUMBA:
+    # compiled kernels for the pair/triplet enumeration; these fill preallocated
+    # output arrays with the combination wavenumbers, overtone counts (the
+    # branch-free integer key for the combination type) and member indices, so
+    # the Python-level loop and fancy-indexing passes are avoided entirely
+    @njit(parallel=True, cache=True)
+    def _combos2(wvn, is_over, out_wvn, out_n_over, out_idx):
+        n = wvn.shape[0]
+        for i in prange(n):
+            # the pairs led by member i start at a fixed offset, so each
+            # thread writes to disjoint slots of the output arrays
+            m = i * (2 * n - i - 1) // 2
+            for j in range(i + 1, n):
+                out_wvn[m] = wvn[i] + wvn[j]
+                out_n_over[m] = is_over[i] + is_over[j]
+                out_idx[m, 0] = i
+                out_idx[m, 1] = j
+                m += 1
+
+    @njit(parallel=True, cache=True)
+    def _combos3(wvn, is_over, out_wvn, out_n_over, out_idx):
+        n = wvn.shape[0]
+        for i in prange(n):
+            # C(n,3) - C(n-i,3) triplets precede those led by member i, so
+            # each thread writes to disjoint slots of the output arrays
+            r = n - i
+            m = (n * (n - 1) * (n - 2) - r * (r - 1) * (r - 2)) // 6
+            for j in range(i + 1, n):
+                # hoist the pair partial sums out of the inner loop
+                s_ij = wvn[i] + wvn[j]
+                o_ij = is_over[i] + is_over[j]
+                for k in range(j + 1, n):
+                    out_wvn[m] = s_ij + wvn[k]
+                    out_n_over[m] = o_ij + is_over[k]
+                    out_idx[m, 0] = i
+                    out_idx[m, 1] = j
+                    out_idx[m, 2] = k
+                    m += 1
+
+@lru_cache(maxsize=128)
+def _combination_tables(wvn: tuple, is_over: tuple) -> tuple:
+    """Pure core of compute_combinations: compute the pair and triplet
+    combination wavenumbers, type codes and member index arrays for the given
+    absorptions, cached on the inputs so that repeated calls with the same
+    fundamentals (e.g. in a sweep varying only one band) are dictionary
+    lookups. The returned arrays are shared between callers and must not be
+    mutated.
+
+    :param wvn: absorption band-centres in wavenumber
+    :type wvn: tuple
+    :param is_over: overtone flag (0/1) per absorption
+    :type is_over: tuple
+    :return: combination wavenumbers, type codes, and (pair, triplet) indices
+    :rtype: tuple
+    """
+    wvn = np.array(wvn)
+    is_over = np.array(is_over, dtype=np.int8)
+    n = len(wvn)
+    # preallocate the full output block up-front - pairs fill the first
+    # C(n,2) slots, triplets the remaining C(n,3)
+    m = comb(n, 2) + comb(n, 3)
+    wvn_out = np.empty(m)
+    code_out = np.empty(m, dtype=np.int8)
+    indices = []
+    start = 0
+    for k in [2,3]:
+        stop = start + comb(n, k)
+        if _HAVE_NUMBA:
+            idx = np.empty((comb(n, k), k), dtype=np.intp)
+            n_over = np.empty(comb(n, k), dtype=np.int8)
+            if k == 2:
+                _combos2(wvn, is_over, wvn_out[start:stop], n_over, idx)
+            else:
+                _combos3(wvn, is_over, wvn_out[start:stop], n_over, idx)
+        else:
+            if k == 2:
+                idx = _pair_indices(n)
+                sums = wvn[idx[:, 0]] + wvn[idx[:, 1]]
+                pair_sums = sums
+                pair_reps = n - 1 - idx[:, 1]
+            else:
+                idx = _triplet_indices(n)
+                # the triplets enumerate each pair with every third member,
+                # in pair order, so the pair sums are reused rather than
+                # re-added for every triplet
+                sums = np.repeat(pair_sums, pair_reps) + wvn[idx[:, 2]]
+            wvn_out[start:stop] = sums
+            n_over = is_over[idx].sum(axis=1)
+        # because the table is order-normalized (fundamentals first), the
+        # overtone count alone keys the combination type and level
+        code_out[start:stop] = CODE_TABLE[k - 1, n_over]
+        indices.append(idx)
+        start = stop
+    return wvn_out, code_out, tuple(indices)
 
 if __name__ == "__main__":
 
@@ -5,11 +5,24 @@ Author: Roger Stabbins, NHM
 Date: 05-09-2022
 """
 import unittest
+from unittest import mock
 import os
+import tempfile
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import ir_active_bands as irab
 
+def compact_dtypes(expected: pd.DataFrame) -> pd.DataFrame:
+    """Cast an expected absorptions table to the compact dtypes used by the
+    library: categorical type and float32 level.
+    """
+    expected = expected.copy()
+    expected['type'] = pd.Categorical(
+        expected['type'], categories=list(irab.ir_active_bands.LEVELS.keys()))
+    expected['level'] = expected['level'].astype('float32')
+    return expected
+
 class TestIRActiveBands(unittest.TestCase):
     """Class to test ir_active_bands
     """
@@ -33,7 +46,7 @@ class TestIRActiveBands(unittest.TestCase):
     def test_combine(self):
         """Unit Test of the band combination function
         """
-        fundamentals = pd.DataFrame(data={'band-centre': [1, 10, 100]}, index=['v1','v2','v3'])
+        fundamentals = np.array([1.0, 10.0, 100.0])
         result = irab.combine(fundamentals)
         expected = 0.9009009009009009 # in wavenumbers: 11100 = 10000 + 1000 + 100
         self.assertAlmostEqual(result, expected, places=7)
@@ -49,6 +62,7 @@ class TestIRActiveBands(unittest.TestCase):
                     'level': 1.0},
             index=['v1']
         )
+        expected = compact_dtypes(expected)
         with self.subTest():
             pd.testing.assert_frame_equal(result.absorptions, expected)
         with self.subTest():
@@ -65,6 +79,7 @@ class TestIRActiveBands(unittest.TestCase):
                     'level': 1.0},
             index=['v1']
         )
+        expected = compact_dtypes(expected)
         with self.subTest():
             pd.testing.assert_frame_equal(result.absorptions, expected)
         with self.subTest():
@@ -90,7 +105,7 @@ class TestIRActiveBands(unittest.TestCase):
         with self.subTest():
             self.assertDictEqual(result_overtones, expected_overtones)
         with self.subTest():
-            pd.testing.assert_frame_equal(expected_absorptions, result_absorptions)
+            pd.testing.assert_frame_equal(compact_dtypes(expected_absorptions), result_absorptions)
 
     def test_compute_combinations(self):
         """Unit Test of the IRActiveBands.compute_combinations function
@@ -121,7 +136,56 @@ class TestIRActiveBands(unittest.TestCase):
                     'level': [1.0, 0.9, 0.9, 0.7, 0.7, 0.6, 0.3]},
             index=['v1', '2v1', '3v1', 'v1+2v1', 'v1+3v1', '2v1+3v1', 'v1+2v1+3v1']
         )
-        pd.testing.assert_frame_equal(expected, result)
+        pd.testing.assert_frame_equal(compact_dtypes(expected), result)
+
+    def test_get_ir_active_bands(self):
+        """Unit Test of the cached get_ir_active_bands factory
+        """
+        first = irab.get_ir_active_bands('OH')
+        second = irab.get_ir_active_bands('OH')
+
+        with self.subTest():
+            self.assertIs(first, second)
+        with self.subTest():
+            self.assertIn('v1+2v1+3v1', first.absorptions.index)
+
+    def test_get_ir_active_bands_disk_cache(self):
+        """Unit Test of the on-disk absorptions table cache
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.object(
+                    irab.ir_active_bands, 'CACHE_DIR', Path(cache_dir)):
+                irab.get_ir_active_bands.cache_clear()
+                computed = irab.get_ir_active_bands('H2O')
+                cache_file = irab.ir_active_bands._cache_path('H2O')
+                with self.subTest():
+                    self.assertTrue(cache_file.exists())
+                irab.get_ir_active_bands.cache_clear()
+                loaded = irab.get_ir_active_bands('H2O')
+                with self.subTest():
+                    pd.testing.assert_frame_equal(
+                        computed.absorptions, loaded.absorptions)
+        irab.get_ir_active_bands.cache_clear()
+
+    def test_filter_absorptions(self):
+        """Unit Test of the IRActiveBands.filter_absorptions function
+        """
+        test_molecule = {'test_molecule': {'v1': 1.0}}
+        test_absorptions = irab.IRActiveBands(test_molecule)
+        test_absorptions.compute_overtones()
+        dropped = test_absorptions.filter_absorptions([0.4, 2.0])
+
+        expected_absorptions = pd.DataFrame(
+            data={'band-centre': [1.0, 1.0 / 2],
+                    'type': ['fundamental', 'overtone'],
+                    'level': [1.0, 0.9]},
+            index=['v1', '2v1']
+        )
+        with self.subTest():
+            self.assertListEqual(list(dropped), ['3v1'])
+        with self.subTest():
+            pd.testing.assert_frame_equal(
+                compact_dtypes(expected_absorptions), test_absorptions.absorptions)
 
     def test_export_absorptions(self):
         """Unit Test of the exporting of absorptions DataFrame to csv